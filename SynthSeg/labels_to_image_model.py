@@ -235,63 +235,50 @@ def labels_to_image_model(labels_shape,
 
 def get_shapes(labels_shape, output_shape, atlas_res, target_res, output_div_by_n):
 
-    # reformat resolutions to lists
-    atlas_res = utils.reformat_to_list(atlas_res)
+    # reformat resolutions and label shape to arrays
+    atlas_res = np.array(utils.reformat_to_list(atlas_res))
     n_dims = len(atlas_res)
-    target_res = utils.reformat_to_list(target_res)
+    target_res = np.array(utils.reformat_to_list(target_res))
+    labels_shape = np.array(labels_shape[:n_dims], dtype='int')
 
     # get resampling factor
-    if atlas_res != target_res:
-        resample_factor = [atlas_res[i] / float(target_res[i]) for i in range(n_dims)]
+    if np.any(atlas_res != target_res):
+        resample_factor = atlas_res / target_res.astype('float')
+        resampled_labels_shape = (labels_shape * resample_factor).astype('int')
     else:
         resample_factor = None
+        resampled_labels_shape = labels_shape
+
+    # label maps only need to be cropped if the output shape is constrained
+    crop_labels = (output_shape is not None) or (output_div_by_n is not None)
 
     # output shape specified, need to get cropping shape, and resample shape if necessary
     if output_shape is not None:
-        output_shape = utils.reformat_to_list(output_shape, length=n_dims, dtype='int')
 
         # make sure that output shape is smaller or equal to label shape
-        if resample_factor is not None:
-            output_shape = [min(int(labels_shape[i] * resample_factor[i]), output_shape[i]) for i in range(n_dims)]
-        else:
-            output_shape = [min(labels_shape[i], output_shape[i]) for i in range(n_dims)]
+        output_shape = np.minimum(resampled_labels_shape, utils.reformat_to_list(output_shape, n_dims, dtype='int'))
 
         # make sure output shape is divisible by output_div_by_n
         if output_div_by_n is not None:
-            tmp_shape = [utils.find_closest_number_divisible_by_m(s, output_div_by_n) for s in output_shape]
-            if output_shape != tmp_shape:
-                print('output shape {0} not divisible by {1}, changed to {2}'.format(output_shape, output_div_by_n,
-                                                                                     tmp_shape))
+            tmp_shape = output_shape // output_div_by_n * output_div_by_n
+            if np.any(output_shape != tmp_shape):
+                print('output shape {0} not divisible by {1}, changed to {2}'.format(output_shape.tolist(),
+                                                                                     output_div_by_n,
+                                                                                     tmp_shape.tolist()))
                 output_shape = tmp_shape
 
-        # get cropping and resample shape
-        if resample_factor is not None:
-            cropping_shape = [int(np.around(output_shape[i]/resample_factor[i], 0)) for i in range(n_dims)]
-        else:
-            cropping_shape = output_shape
-
     # no output shape specified, so no cropping unless label_shape is not divisible by output_div_by_n
     else:
-
-        # make sure output shape is divisible by output_div_by_n
+        output_shape = resampled_labels_shape
         if output_div_by_n is not None:
+            output_shape = output_shape // output_div_by_n * output_div_by_n
 
-            # if resampling, get the potential output_shape and check if it is divisible by n
-            if resample_factor is not None:
-                output_shape = [int(labels_shape[i] * resample_factor[i]) for i in range(n_dims)]
-                output_shape = [utils.find_closest_number_divisible_by_m(s, output_div_by_n) for s in output_shape]
-                cropping_shape = [int(np.around(output_shape[i] / resample_factor[i], 0)) for i in range(n_dims)]
-            # if no resampling, simply check if image_shape is divisible by n
-            else:
-                cropping_shape = [utils.find_closest_number_divisible_by_m(s, output_div_by_n) for s in labels_shape]
-                output_shape = cropping_shape
-
-        # if no need to be divisible by n, simply take cropping_shape as image_shape, and build output_shape
-        else:
-            cropping_shape = labels_shape
-            if resample_factor is not None:
-                output_shape = [int(cropping_shape[i] * resample_factor[i]) for i in range(n_dims)]
-            else:
-                output_shape = cropping_shape
+    # get cropping shape by bringing output shape back to the resolution of the label maps
+    if resample_factor is None:
+        cropping_shape = output_shape
+    elif crop_labels:
+        cropping_shape = np.around(output_shape / resample_factor).astype('int')
+    else:
+        cropping_shape = labels_shape
 
-    return cropping_shape, output_shape
+    return cropping_shape.tolist(), output_shape.tolist()
@@ -25,6 +25,7 @@ import numpy as np
 import tensorflow as tf
 from keras import models
 import keras.callbacks as KC
+import keras.backend as K
 from keras.optimizers import Adam
 from inspect import getmembers, isclass
 
@@ -311,7 +312,8 @@ def train_model(model,
                 model_dir,
                 metric_type,
                 path_checkpoint=None,
-                reinitialise_momentum=False):
+                reinitialise_momentum=False,
+                loss_scale=None):
 
     # prepare model and log folders
     utils.mkdir(model_dir)
@@ -334,7 +336,8 @@ def train_model(model,
         if (not reinitialise_momentum) & (metric_type in path_checkpoint):
             custom_l2i = {key: value for (key, value) in getmembers(layers, isclass) if key != 'Layer'}
             custom_nrn = {key: value for (key, value) in getmembers(nrn_layers, isclass) if key != 'Layer'}
-            custom_objects = {**custom_l2i, **custom_nrn, 'tf': tf, 'keras': keras, 'loss': metrics.IdentityLoss().loss}
+            custom_objects = {**custom_l2i, **custom_nrn, 'tf': tf, 'keras': keras, 'loss': metrics.IdentityLoss().loss,
+                              'LossScaledAdam': LossScaledAdam}
             model = models.load_model(path_checkpoint, custom_objects=custom_objects)
             compile_model = False
         else:
@@ -342,11 +345,91 @@ def train_model(model,
 
     # compile
     if compile_model:
-        model.compile(optimizer=Adam(lr=learning_rate), loss=metrics.IdentityLoss().loss)
+        optimizer = Adam(lr=learning_rate) if loss_scale is None else LossScaledAdam(loss_scale, lr=learning_rate)
+        model.compile(optimizer=optimizer, loss=metrics.IdentityLoss().loss)
+
+    # tf.data pipelines already prepare batches in the background, so they are consumed in the main thread instead of
+    # going through the python queue of fit_generator
+    workers = 1
+    if isinstance(generator, tf.data.Dataset):
+        generator = (([v.numpy() for v in inputs], target.numpy()) for inputs, target in generator)
+        workers = 0
 
     # fit
     model.fit_generator(generator,
                         epochs=n_epochs,
                         steps_per_epoch=n_steps,
                         callbacks=callbacks,
-                        initial_epoch=init_epoch)
+                        initial_epoch=init_epoch,
+                        workers=workers)
+
+
+class LossScaledAdam(Adam):
+    """Adam optimiser with dynamic loss scaling, to be used when training with float16 operations.
+    The loss is multiplied by the current loss scale before computing the gradients (so that small float16 gradients do
+    not underflow), and the gradients are divided by the same factor before updating the float32 weights.
+    If any gradient is not finite (overflow), the whole update is skipped and the loss scale is halved. The loss scale
+    is doubled after growth_steps consecutive steps with finite gradients."""
+
+    def __init__(self, loss_scale=2. ** 15, growth_steps=2000, **kwargs):
+        self.initial_loss_scale = loss_scale
+        self.growth_steps = growth_steps
+        super(LossScaledAdam, self).__init__(**kwargs)
+        with K.name_scope(self.__class__.__name__):
+            self.loss_scale = K.variable(loss_scale, dtype='float32', name='loss_scale')
+            self.good_steps = K.variable(0, dtype='int64', name='good_steps')
+
+    def get_gradients(self, loss, params):
+        grads = super(LossScaledAdam, self).get_gradients(loss * self.loss_scale, params)
+        return [g / self.loss_scale for g in grads]
+
+    @K.symbolic
+    def get_updates(self, loss, params):
+        grads = self.get_gradients(loss, params)
+        finite = tf.reduce_all(tf.stack([tf.reduce_all(tf.math.is_finite(g)) for g in grads]))
+
+        # update loss scale
+        good_steps = tf.where(finite, self.good_steps + 1, tf.zeros_like(self.good_steps))
+        grow = K.greater_equal(good_steps, self.growth_steps)
+        loss_scale = tf.where(finite, tf.where(grow, self.loss_scale * 2., self.loss_scale), self.loss_scale / 2.)
+        self.updates = [K.update(self.loss_scale, K.maximum(loss_scale, 1.)),
+                        K.update(self.good_steps, tf.where(grow, tf.zeros_like(good_steps), good_steps)),
+                        K.update_add(self.iterations, K.cast(finite, 'int64'))]
+
+        # Adam step, as in keras.optimizers.Adam, but all states are left unchanged if the gradients are not finite
+        lr = self.learning_rate
+        if self.initial_decay > 0:
+            lr = lr * (1. / (1. + self.decay * K.cast(self.iterations, K.dtype(self.decay))))
+        t = K.cast(self.iterations, K.floatx()) + 1
+        lr_t = lr * (K.sqrt(1. - K.pow(self.beta_2, t)) / (1. - K.pow(self.beta_1, t)))
+
+        ms = [K.zeros(K.int_shape(p), dtype=K.dtype(p), name='m_' + str(i)) for (i, p) in enumerate(params)]
+        vs = [K.zeros(K.int_shape(p), dtype=K.dtype(p), name='v_' + str(i)) for (i, p) in enumerate(params)]
+        if self.amsgrad:
+            vhats = [K.zeros(K.int_shape(p), dtype=K.dtype(p), name='vhat_' + str(i)) for (i, p) in enumerate(params)]
+        else:
+            vhats = [K.zeros(1, name='vhat_' + str(i)) for i in range(len(params))]
+        self.weights = [self.iterations, self.loss_scale, self.good_steps] + ms + vs + vhats
+
+        for p, g, m, v, vhat in zip(params, grads, ms, vs, vhats):
+            m_t = (self.beta_1 * m) + (1. - self.beta_1) * g
+            v_t = (self.beta_2 * v) + (1. - self.beta_2) * K.square(g)
+            if self.amsgrad:
+                vhat_t = K.maximum(vhat, v_t)
+                p_t = p - lr_t * m_t / (K.sqrt(vhat_t) + self.epsilon)
+                self.updates.append(K.update(vhat, tf.where(finite, vhat_t, vhat)))
+            else:
+                p_t = p - lr_t * m_t / (K.sqrt(v_t) + self.epsilon)
+            if getattr(p, 'constraint', None) is not None:
+                p_t = p.constraint(p_t)
+            self.updates.append(K.update(m, tf.where(finite, m_t, m)))
+            self.updates.append(K.update(v, tf.where(finite, v_t, v)))
+            self.updates.append(K.update(p, tf.where(finite, p_t, p)))
+
+        return self.updates
+
+    def get_config(self):
+        config = super().get_config()
+        config["loss_scale"] = self.initial_loss_scale
+        config["growth_steps"] = self.growth_steps
+        return config
@@ -180,24 +180,23 @@ def training(list_paths_input_labels,
                                 skip_n_concatenations=skip_n_concatenations,
                                 name='l2l')
 
-    # input generator
-    model_inputs = build_model_inputs(path_inputs=list_paths_input_labels,
-                                      path_outputs=list_paths_target_labels,
-                                      batchsize=batchsize,
-                                      subjects_prob=subjects_prob,
-                                      dtype_input='int32')
-    input_generator = utils.build_training_generator(model_inputs, batchsize)
+    # input pipeline
+    input_dataset = build_model_inputs(path_inputs=list_paths_input_labels,
+                                       path_outputs=list_paths_target_labels,
+                                       batchsize=batchsize,
+                                       subjects_prob=subjects_prob,
+                                       dtype_input='int32')
 
     # pre-training with weighted L2, input is fit to the softmax rather than the probabilities
     if wl2_epochs > 0:
         wl2_model = models.Model(l2l_model.inputs, [l2l_model.get_layer('l2l_likelihood').output])
         wl2_model = metrics.metrics_model(wl2_model, target_label_list, 'wl2')
-        train_model(wl2_model, input_generator, lr, wl2_epochs, steps_per_epoch, model_dir, 'wl2', checkpoint)
+        train_model(wl2_model, input_dataset, lr, wl2_epochs, steps_per_epoch, model_dir, 'wl2', checkpoint)
         checkpoint = os.path.join(model_dir, 'wl2_%03d.h5' % wl2_epochs)
 
     # fine-tuning with dice metric
     dice_model = metrics.metrics_model(l2l_model, target_label_list, 'dice')
-    train_model(dice_model, input_generator, lr, dice_epochs, steps_per_epoch, model_dir, 'dice', checkpoint)
+    train_model(dice_model, input_dataset, lr, dice_epochs, steps_per_epoch, model_dir, 'dice', checkpoint)
 
 
 def build_augmentation_model(labels_shape,
@@ -21,11 +21,13 @@ License.
 
 # python imports
 import os
+import functools
+import collections
 import numpy as np
 import tensorflow as tf
 from keras import models
 import keras.layers as KL
-import numpy.random as npr
+from keras.backend.tensorflow_backend import get_graph
 
 # project imports
 from SynthSeg import metrics_model as metrics
@@ -73,7 +75,11 @@ def training(image_dir,
              wl2_epochs=1,
              dice_epochs=50,
              steps_per_epoch=10000,
-             checkpoint=None):
+             checkpoint=None,
+             cache_inputs=False,
+             tfrecords_dir=None,
+             mixed_precision=False,
+             xla=False):
     """
     This function trains a UNet to segment MRI images with real scans and corresponding ground truth labels.
     We regroup the parameters in four categories: General, Augmentation, Architecture, Training.
@@ -181,6 +187,22 @@ def training(image_dir,
     :param steps_per_epoch: (optional) number of steps per epoch. Default is 10000. Since no online validation is
     possible, this is equivalent to the frequency at which the models are saved.
     :param checkpoint: (optional) path of an already saved model to load before starting the training.
+    :param cache_inputs: (optional) whether to keep all the training images and label maps in memory after they have
+    been read once, instead of reading them from disk at each minibatch. Augmentation is still applied on the fly.
+    This requires enough RAM to hold the whole decoded training set (e.g. about 134MB per subject for a float32 image
+    and int32 labels of size 256^3), and all subjects are read before the first training step. Default is False.
+    :param tfrecords_dir: (optional) path of a directory where to convert the training data to TFRecord files before
+    training (only missing files are written, so the conversion is done once). The label maps are stored as int16, and
+    the training volumes are then read from these files. Default is None, where images are read from image_dir and
+    labels_dir.
+    :param mixed_precision: (optional) whether to enable the automatic mixed precision graph rewrite of tensorflow,
+    which runs convolutions and matrix multiplications (and the compatible operations around them) in float16, while
+    keeping all variables in float32. In practice this mostly concerns the UNet: the spatial, bias field and intensity
+    augmentations stay in float32. The loss is then scaled by a dynamic factor to prevent float16 gradients from
+    underflowing, and steps with overflowing gradients are skipped. This only has an effect on GPUs. Default is False.
+    :param xla: (optional) whether to let tensorflow compile clusters of compatible operations with XLA, which fuses
+    chains of element-wise operations (e.g. in the intensity augmentation) into single kernels. Operations that XLA
+    cannot compile are left out of the clusters. Default is False.
     """
 
     # check epochs
@@ -192,6 +214,14 @@ def training(image_dir,
     path_labels = utils.list_images_in_folder(labels_dir)
     assert len(path_images) == len(path_labels), "There should be as many images as label maps."
 
+    # let the graph optimiser cast float operations to float16 where possible, and scale the loss accordingly
+    # (the option is set in both cases, since it is global to the process and may have been enabled by a previous run)
+    tf.config.optimizer.set_experimental_options({'auto_mixed_precision': bool(mixed_precision)})
+    loss_scale = 2. ** 15 if mixed_precision else None
+
+    # let XLA fuse compatible operations (also set in both cases, since it is global to the process)
+    tf.config.optimizer.set_jit(bool(xla))
+
     # get label lists
     label_list, _ = utils.get_list_labels(label_list=segmentation_labels, labels_dir=labels_dir)
     n_labels = np.size(label_list)
@@ -236,22 +266,72 @@ def training(image_dir,
                                  batch_norm=-1,
                                  name='unet')
 
-    # input generator
-    generator = build_model_inputs(path_images, path_labels, batchsize, subjects_prob)
-    input_generator = utils.build_training_generator(generator, batchsize)
+    # convert training data to TFRecords if necessary
+    path_tfrecords = write_tfrecords(path_images, path_labels, tfrecords_dir) if tfrecords_dir is not None else None
+
+    # input pipeline
+    input_dataset = build_model_inputs(path_images,
+                                       path_labels,
+                                       batchsize,
+                                       subjects_prob,
+                                       cache_inputs=cache_inputs,
+                                       im_shape=im_shape,
+                                       n_channels=n_channels,
+                                       path_tfrecords=path_tfrecords)
 
     # pre-training with weighted L2, input is fit to the softmax rather than the probabilities
     if wl2_epochs > 0:
         wl2_model = models.Model(unet_model.inputs, [unet_model.get_layer('unet_likelihood').output])
         wl2_model = metrics.metrics_model(wl2_model, label_list, 'wl2')
-        train_model(wl2_model, input_generator, lr, wl2_epochs, steps_per_epoch, model_dir, 'wl2', checkpoint)
+        train_model(wl2_model, input_dataset, lr, wl2_epochs, steps_per_epoch, model_dir, 'wl2', checkpoint,
+                    loss_scale=loss_scale)
         checkpoint = os.path.join(model_dir, 'wl2_%03d.h5' % wl2_epochs)
 
     # fine-tuning with dice metric
     dice_model = metrics.metrics_model(unet_model, label_list, 'dice')
-    train_model(dice_model, input_generator, lr, dice_epochs, steps_per_epoch, model_dir, 'dice', checkpoint)
+    train_model(dice_model, input_dataset, lr, dice_epochs, steps_per_epoch, model_dir, 'dice', checkpoint,
+                loss_scale=loss_scale)
+
+
+def _to_hashable(value):
+    """Convert numpy arrays and (nested) lists to tuples, so that they can be used as dictionary keys."""
+    if isinstance(value, np.ndarray):
+        return value.dtype.str, value.shape, tuple(value.ravel().tolist())
+    elif isinstance(value, (list, tuple)):
+        return tuple(_to_hashable(v) for v in value)
+    else:
+        return value
+
+
+def _cache_per_graph(maxsize=8):
+    """Memoise a model-building function on its arguments, so that successive trainings with the same parameters
+    reuse the same model instead of rebuilding it. At most maxsize models are kept (the least recently used ones are
+    dropped first). Cached models are only reused while the keras graph they belong to is still in use, the cache is
+    emptied as soon as a new graph is created (e.g. by keras.backend.clear_session())."""
+
+    def decorator(build_function):
+        cache = {'graph': None, 'models': collections.OrderedDict()}
+
+        @functools.wraps(build_function)
+        def cached_build_function(*args, **kwargs):
+            if cache['graph'] is not get_graph():
+                cache['graph'] = get_graph()
+                cache['models'].clear()
+            key = _to_hashable(args) + _to_hashable(sorted(kwargs.items()))
+            if key in cache['models']:
+                cache['models'].move_to_end(key)
+            else:
+                cache['models'][key] = build_function(*args, **kwargs)
+                if len(cache['models']) > maxsize:
+                    cache['models'].popitem(last=False)
+            return cache['models'][key]
+
+        return cached_build_function
 
+    return decorator
 
+
+@_cache_per_graph(maxsize=8)
 def build_augmentation_model(im_shape,
                              n_channels,
                              segmentation_labels,
@@ -362,43 +442,180 @@ def build_model_inputs(path_inputs,
                        batchsize=1,
                        subjects_prob=None,
                        dtype_input='float32',
-                       dtype_output='int32'):
-
-    # get label info
-    _, _, _, n_channels, _, _ = utils.get_volume_info(path_inputs[0])
+                       dtype_output='int32',
+                       cache_inputs=False,
+                       im_shape=None,
+                       n_channels=None,
+                       path_tfrecords=None):
+
+    # get image info, unless it has already been read by the caller
+    if (im_shape is None) | (n_channels is None):
+        im_shape, _, _, n_channels, _, _ = utils.get_volume_info(path_inputs[0], aff_ref=np.eye(4))
+    im_shape = list(im_shape)
+    n_dims = len(im_shape)
+    input_shape = im_shape + [n_channels]
+    output_shape = im_shape + [1]
+    aff_ref = np.eye(4)
+    n_subjects = len(path_outputs)
 
     # make sure subjects_prob sums to 1
+    subjects_prob = utils.load_array_if_path(subjects_prob)
     if subjects_prob is not None:
+        subjects_prob = np.array(subjects_prob, dtype='float32')
         subjects_prob /= np.sum(subjects_prob)
 
-    # Generate!
-    while True:
-
-        # randomly pick as many images as batchsize
-        indices = npr.choice(np.arange(len(path_outputs)), size=batchsize, p=subjects_prob)
-
-        # initialise input lists
-        list_batch_inputs = list()
-        list_batch_outputs = list()
-
-        for idx in indices:
-
-            # get a batch input
-            batch_input = utils.load_volume(path_inputs[idx], aff_ref=np.eye(4), dtype=dtype_input)
-            if n_channels > 1:
-                list_batch_inputs.append(utils.add_axis(batch_input, axis=0))
-            else:
-                list_batch_inputs.append(utils.add_axis(batch_input, axis=[0, -1]))
+    dtypes = [tf.as_dtype(dtype_input), tf.as_dtype(dtype_output)]
+
+    def decode_pair(idx, data_input, data_output):
+        batch_input = utils.load_volume(path_inputs[idx], aff_ref=aff_ref, dtype=dtype_input,
+                                        data=data_input.tobytes())
+        batch_output = utils.load_volume(path_outputs[idx], aff_ref=aff_ref, dtype=dtype_output,
+                                         data=data_output.tobytes())
+
+        # check shapes before reshaping, so that volumes of different sizes are not silently scrambled
+        for path, volume in zip([path_inputs[idx], path_outputs[idx]], [batch_input, batch_output]):
+            if list(volume.shape[:n_dims]) != im_shape:
+                raise Exception('all training volumes should have shape {0} after alignment, '
+                                'got {1} for {2}'.format(im_shape, list(volume.shape[:n_dims]), path))
+        return np.reshape(batch_input, input_shape), np.reshape(batch_output, output_shape)
+
+    def load_pair_tensors(idx):
+        # files are read by tensorflow ops, only the decoding of their content is done in python. File contents are
+        # passed as uint8 arrays, since numpy strips the trailing null bytes of string tensors (e.g. in gz files)
+        data_input = tf.io.decode_raw(tf.io.read_file(tf.gather(path_inputs, idx)), tf.uint8)
+        data_output = tf.io.decode_raw(tf.io.read_file(tf.gather(path_outputs, idx)), tf.uint8)
+        batch_input, batch_output = tf.numpy_function(decode_pair, [idx, data_input, data_output], dtypes)
+        batch_input.set_shape(input_shape)
+        batch_output.set_shape(output_shape)
+        return idx, batch_input, batch_output
+
+    def parse_example(idx, example):
+        features = tf.io.parse_single_example(example, {'input': tf.io.FixedLenFeature([], tf.string),
+                                                        'output': tf.io.FixedLenFeature([], tf.string),
+                                                        'input_shape': tf.io.FixedLenFeature([n_dims + 1], tf.int64),
+                                                        'output_shape': tf.io.FixedLenFeature([n_dims + 1], tf.int64),
+                                                        'input_dtype': tf.io.FixedLenFeature([], tf.string)})
+        # make sure that the records were written with the expected shapes and dtype before decoding them
+        checks = [tf.debugging.assert_equal(features['input_shape'], tf.constant(input_shape, dtype=tf.int64),
+                                            message='TFRecord input shape does not match {}'.format(input_shape)),
+                  tf.debugging.assert_equal(features['output_shape'], tf.constant(output_shape, dtype=tf.int64),
+                                            message='TFRecord output shape does not match {}'.format(output_shape)),
+                  tf.debugging.assert_equal(features['input_dtype'], tf.constant(dtypes[0].name),
+                                            message='TFRecord input dtype is not {}'.format(dtypes[0].name))]
+        with tf.control_dependencies(checks):
+            batch_input = tf.reshape(tf.io.decode_raw(features['input'], dtypes[0]), input_shape)
+            batch_output = tf.reshape(tf.io.decode_raw(features['output'], tf.int16), output_shape)
+        return idx, batch_input, batch_output
+
+    def read_tfrecord(idx):
+        return tf.data.TFRecordDataset(tf.gather(path_tfrecords, idx)).map(lambda x: parse_example(idx, x))
+
+    def load_subjects(indices):
+        if path_tfrecords is not None:
+            return indices.interleave(read_tfrecord,
+                                      cycle_length=min(16, n_subjects),
+                                      num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        else:
+            return indices.map(load_pair_tensors, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
-            # get a batch output
-            batch_output = utils.load_volume(path_outputs[idx], aff_ref=np.eye(4), dtype=dtype_output)
-            list_batch_outputs.append(utils.add_axis(batch_output, axis=[0, -1]))
+    # if possible, load all volumes once and keep them in memory rather than reading them again at each pass
+    dataset = tf.data.Dataset.range(n_subjects)
+    if cache_inputs:
+        dataset = load_subjects(dataset).cache()
 
-        # build list of training pairs
-        list_training_pairs = [list_batch_inputs, list_batch_outputs]
-        if batchsize > 1:  # concatenate individual input types if batchsize > 1
-            list_training_pairs = [np.concatenate(item, 0) for item in list_training_pairs]
-        else:
-            list_training_pairs = [item[0] for item in list_training_pairs]
+    # randomly pick subjects, all subjects are seen once per pass if subjects_prob is None
+    dataset = dataset.shuffle(n_subjects, reshuffle_each_iteration=True).repeat()
+    if subjects_prob is not None:
+        dataset = dataset.apply(tf.data.experimental.rejection_resample(lambda idx, *_: tf.cast(idx, 'int32'),
+                                                                        target_dist=subjects_prob,
+                                                                        initial_dist=[1 / n_subjects] * n_subjects))
+        dataset = dataset.map(lambda _, data: data)
+
+    # load volumes in parallel, and prepare the next batches while the current one is being used
+    if not cache_inputs:
+        dataset = load_subjects(dataset)
+    dataset = dataset.map(lambda idx, batch_input, batch_output: (batch_input, tf.cast(batch_output, dtypes[1])))
+    dataset = dataset.batch(batchsize)
+
+    # add dummy target, since the loss is computed inside the model
+    dataset = dataset.map(lambda batch_input, batch_output: ((batch_input, batch_output), tf.zeros([batchsize, 1])))
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    # enable static optimisations of the pipeline, and allow elements to be produced out of order
+    options = tf.data.Options()
+    options.experimental_deterministic = False
+    options.experimental_optimization.autotune = True
+    options.experimental_optimization.map_fusion = True
+    options.experimental_optimization.map_and_batch_fusion = True
+    options.experimental_threading.private_threadpool_size = os.cpu_count()
+
+    return dataset.with_options(options)
+
+
+def write_tfrecords(path_inputs, path_outputs, tfrecords_dir, dtype_input='float32'):
+    """Convert pairs of training volumes to TFRecord files (one per subject), which can then be read directly by the
+    input pipeline of build_model_inputs. Volumes are aligned to the identity affine matrix, inputs are stored with the
+    given dtype, and label maps are stored as int16. Each record also keeps the shapes and input dtype (checked when
+    reading the records), as well as the paths and modification times of its source files. Files that already exist in
+    tfrecords_dir are only written again if they were obtained from different source files or with another dtype.
+    :param path_inputs: list of paths of the input volumes
+    :param path_outputs: list of paths of the corresponding label maps
+    :param tfrecords_dir: path of the directory where to save the TFRecord files
+    :param dtype_input: (optional) dtype with which to store the input volumes. Default is float32.
+    :return: list of paths of the TFRecord files, ordered like path_outputs.
+    """
 
-        yield list_training_pairs
+    utils.mkdir(tfrecords_dir)
+    dtype_input = np.dtype(dtype_input).name
+    path_tfrecords = list()
+    for path_input, path_output in zip(path_inputs, path_outputs):
+
+        path_tfrecord = os.path.join(tfrecords_dir, utils.strip_extension(os.path.basename(path_output)) + '.tfrecord')
+        sources = [os.path.abspath(path_input), os.path.abspath(path_output)]
+        mtimes = [os.stat(path).st_mtime_ns for path in sources]
+        if not _is_up_to_date_tfrecord(path_tfrecord, sources, mtimes, dtype_input):
+
+            # read volumes
+            volume_input = utils.load_volume(path_input, aff_ref=np.eye(4), dtype=dtype_input)
+            volume_output = utils.load_volume(path_output, aff_ref=np.eye(4), dtype='int32')
+            int16_info = np.iinfo('int16')
+            assert (np.min(volume_output) >= int16_info.min) & (np.max(volume_output) <= int16_info.max), \
+                'label values of %s do not fit in int16' % path_output
+            n_dims, n_channels = utils.get_dims(list(volume_input.shape))
+            input_shape = list(volume_input.shape[:n_dims]) + [n_channels]
+            output_shape = list(volume_output.shape[:n_dims]) + [1]
+
+            # write them in a temporary file first, so that interrupted conversions are not mistaken as finished
+            feature = {'input': tf.train.Feature(bytes_list=tf.train.BytesList(value=[volume_input.tobytes()])),
+                       'output': tf.train.Feature(bytes_list=tf.train.BytesList(
+                           value=[volume_output.astype('int16').tobytes()])),
+                       'input_shape': tf.train.Feature(int64_list=tf.train.Int64List(value=input_shape)),
+                       'output_shape': tf.train.Feature(int64_list=tf.train.Int64List(value=output_shape)),
+                       'input_dtype': tf.train.Feature(bytes_list=tf.train.BytesList(value=[dtype_input.encode()])),
+                       'sources': tf.train.Feature(bytes_list=tf.train.BytesList(value=[p.encode() for p in sources])),
+                       'mtimes': tf.train.Feature(int64_list=tf.train.Int64List(value=mtimes))}
+            example = tf.train.Example(features=tf.train.Features(feature=feature))
+            with tf.io.TFRecordWriter(path_tfrecord + '.tmp') as writer:
+                writer.write(example.SerializeToString())
+            os.replace(path_tfrecord + '.tmp', path_tfrecord)
+
+        path_tfrecords.append(path_tfrecord)
+
+    return path_tfrecords
+
+
+def _is_up_to_date_tfrecord(path_tfrecord, sources, mtimes, dtype_input):
+    """Check if a TFRecord file written by write_tfrecords exists, and was obtained from the given source files (with
+    the same modification times) and input dtype."""
+    if not os.path.isfile(path_tfrecord):
+        return False
+    try:
+        example = tf.train.Example.FromString(next(iter(tf.data.TFRecordDataset(path_tfrecord))).numpy())
+    except (StopIteration, tf.errors.DataLossError):
+        return False
+    features = example.features.feature
+    if any(key not in features for key in ['sources', 'mtimes', 'input_dtype', 'input_shape', 'output_shape']):
+        return False
+    return ([p.decode() for p in features['sources'].bytes_list.value] == sources) & \
+           (list(features['mtimes'].int64_list.value) == mtimes) & \
+           (features['input_dtype'].bytes_list.value[0].decode() == dtype_input)
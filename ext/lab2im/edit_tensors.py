@@ -295,12 +295,10 @@ def resample_tensor(tensor,
             downsample_shape = [int(tensor_shape[i] * volume_res[i] / subsample_res[i]) for i in range(n_dims)]
 
             # downsample volume
-            tensor._keras_shape = tuple(tensor.get_shape().as_list())
             tensor = nrn_layers.Resize(size=downsample_shape, interp_method='nearest')(tensor)
 
     # resample image at target resolution
     if resample_shape != downsample_shape:  # if we didn't downsample downsample_shape = tensor_shape
-        tensor._keras_shape = tuple(tensor.get_shape().as_list())
         tensor = nrn_layers.Resize(size=resample_shape, interp_method=interp_method)(tensor)
 
     # compute reliability maps if necessary and return results
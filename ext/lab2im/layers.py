@@ -198,6 +198,14 @@ class RandomSpatialDeformation(Layer):
 
         # apply deformations and return tensors with correct dtype
         if self.apply_affine_trans | self.apply_elastic_trans:
+
+            # build the dense deformation field only once, so that it is shared by all inputs
+            if self.apply_affine_trans:
+                if self.apply_elastic_trans:
+                    list_trans = [tf.map_fn(self._non_linear_and_aff_to_shift, list_trans[::-1], dtype=tf.float32)]
+                else:
+                    list_trans = [tf.map_fn(self._aff_to_shift, list_trans[0], dtype=tf.float32)]
+
             if self.prob == 1:
                 inputs = [nrn_layers.SpatialTransformer(m)([v] + list_trans) for (m, v) in
                           zip(self.inter_method, inputs)]
@@ -207,6 +215,12 @@ class RandomSpatialDeformation(Layer):
                           for (m, v) in zip(self.inter_method, inputs)]
         return [tf.cast(v, t) for (t, v) in zip(types, inputs)]
 
+    def _aff_to_shift(self, trf):
+        return nrn_utils.affine_to_shift(trf, list(self.inshape[:self.n_dims]), shift_center=True)
+
+    def _non_linear_and_aff_to_shift(self, trf):
+        return nrn_utils.combine_non_linear_and_aff_to_shift(trf, list(self.inshape[:self.n_dims]), shift_center=True)
+
 
 class RandomCrop(Layer):
     """Randomly crop all input tensors to a given shape. This cropping is applied to all channels.
@@ -248,23 +262,20 @@ class RandomCrop(Layer):
 
     def call(self, inputs, **kwargs):
 
-        # if one input only is provided, performs the cropping directly
-        if not self.several_inputs:
-            return tf.map_fn(self._single_slice, inputs, dtype=inputs.dtype)
-
-        # otherwise we concatenate all inputs before cropping, so that they are all cropped at the same location
-        else:
-            types = [v.dtype for v in inputs]
-            inputs = tf.concat([tf.cast(v, 'float32') for v in inputs], axis=-1)
-            inputs = tf.map_fn(self._single_slice, inputs, dtype=tf.float32)
-            inputs = tf.split(inputs, self.list_n_channels, axis=-1)
-            return [tf.cast(v, t) for (t, v) in zip(types, inputs)]
+        # crop all inputs in the same pass, so that they are all cropped at the same location. Inputs are cropped in
+        # float32, since GPU kernels for slicing int32 tensors run on the host and would copy the volumes back and forth
+        inputs = [inputs] if not self.several_inputs else inputs
+        types = [v.dtype for v in inputs]
+        inputs = [tf.cast(v, 'float32') for v in inputs]
+        inputs = tf.map_fn(self._single_slice, inputs, dtype=[tf.float32] * len(inputs))
+        inputs = [tf.cast(v, t) for (t, v) in zip(types, inputs)]
+        return inputs if self.several_inputs else inputs[0]
 
-    def _single_slice(self, vol):
+    def _single_slice(self, vols):
         crop_idx = tf.cast(tf.random.uniform([self.n_dims], 0, np.array(self.crop_max_val), 'float32'), dtype='int32')
         crop_idx = tf.concat([crop_idx, tf.zeros([1], dtype='int32')], axis=0)
         crop_size = tf.convert_to_tensor(self.crop_shape + [-1], dtype='int32')
-        return tf.slice(vol, begin=crop_idx, size=crop_size)
+        return [tf.slice(vol, begin=crop_idx, size=crop_size) for vol in vols]
 
     def compute_output_shape(self, input_shape):
         output_shape = [tuple([None] + self.crop_shape + [v]) for v in self.list_n_channels]
@@ -396,29 +407,27 @@ class RandomFlip(Layer):
         size = tf.concat([batchsize, len(self.flip_axes) * tf.ones(1, dtype='int32')], axis=0)
         rand_flip = K.less(tf.random.uniform(size, 0, 1), self.prob)
 
-        # swap right/left labels if we apply an odd number of flips
+        # swap right/left labels if we apply an odd number of flips (with a single look-up for the whole batch)
         odd = tf.math.floormod(tf.reduce_sum(tf.cast(rand_flip, 'int32'), -1, keepdims=True), 2) != 0
+        odd = tf.reshape(odd, tf.concat([batchsize, tf.ones([self.n_dims + 1], dtype='int32')], axis=0))
         swapped_inputs = list()
         for i in range(len(inputs)):
             if self.swap_labels[i]:
-                swapped_inputs.append(tf.map_fn(self._single_swap, [inputs[i], odd], dtype=types[i]))
+                swapped = tf.cast(tf.gather(self.swap_lut, inputs[i]), types[i])
+                swapped_inputs.append(tf.where(tf.broadcast_to(odd, tf.shape(inputs[i])), swapped, inputs[i]))
             else:
                 swapped_inputs.append(inputs[i])
 
-        # flip inputs and convert them back to their original type
-        inputs = tf.concat([tf.cast(v, 'float32') for v in swapped_inputs], axis=-1)
-        inputs = tf.map_fn(self._single_flip, [inputs, rand_flip], dtype=tf.float32)
-        inputs = tf.split(inputs, self.list_n_channels, axis=-1)
-
-        return [tf.cast(v, t) for (t, v) in zip(types, inputs)]
-
-    def _single_swap(self, inputs):
-        return K.switch(inputs[1], tf.gather(self.swap_lut, inputs[0]), inputs[0])
+        # flip all inputs in the same pass, so that they are flipped along the same axes (in float32 as for RandomCrop)
+        swapped_inputs = [tf.cast(v, 'float32') for v in swapped_inputs]
+        flipped_inputs = tf.map_fn(self._single_flip, swapped_inputs + [rand_flip], dtype=[tf.float32] * len(inputs))
+        return [tf.cast(v, t) for (t, v) in zip(types, flipped_inputs)]
 
     @staticmethod
     def _single_flip(inputs):
-        flip_axis = tf.where(inputs[1])
-        return K.switch(tf.equal(tf.size(flip_axis), 0), inputs[0], tf.reverse(inputs[0], axis=flip_axis[..., 0]))
+        flip_axis = tf.where(inputs[-1])
+        no_flip = tf.equal(tf.size(flip_axis), 0)
+        return [K.switch(no_flip, v, tf.reverse(v, axis=flip_axis[..., 0])) for v in inputs[:-1]]
 
 
 class SampleConditionalGMM(Layer):
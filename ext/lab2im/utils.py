@@ -56,8 +56,10 @@ License.
 """
 
 
+import io
 import os
 import glob
+import gzip
 import math
 import time
 import pickle
@@ -73,7 +75,7 @@ from scipy.ndimage.morphology import distance_transform_edt
 # ---------------------------------------------- loading/saving functions ----------------------------------------------
 
 
-def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=None):
+def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=None, data=None):
     """
     Load volume file.
     :param path_volume: path of the volume to load. Can either be a nii, nii.gz, mgz, or npz format.
@@ -84,20 +86,28 @@ def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=Non
     :param dtype: (optional) if not None, convert the loaded volume to this numpy dtype.
     :param aff_ref: (optional) If not None, the loaded volume is aligned to this affine matrix.
     The returned affine matrix is also given in this new space. Must be a numpy array of dimension 4x4.
+    :param data: (optional) raw content of the file located at path_volume, if it has already been read (e.g. with
+    tf.io.read_file). The volume is then decoded from these bytes, and path_volume is only used to get the file format.
     :return: the volume, with corresponding affine matrix and header if im_only is False.
     """
     assert path_volume.endswith(('.nii', '.nii.gz', '.mgz', '.npz')), 'Unknown data file: %s' % path_volume
 
     if path_volume.endswith(('.nii', '.nii.gz', '.mgz')):
-        x = nib.load(path_volume)
+        if data is None:
+            x = nib.load(path_volume)
+        else:  # mgz files are gzipped mgh files
+            data = gzip.decompress(data) if path_volume.endswith(('.gz', '.mgz')) else data
+            x = nib.MGHImage.from_bytes(data) if path_volume.endswith('.mgz') else nib.Nifti1Image.from_bytes(data)
+        # directly read float volumes with the requested precision, to avoid an intermediate float64 copy
+        fdata_dtype = dtype if (dtype is not None) and (np.dtype(dtype).kind == 'f') else np.float64
         if squeeze:
-            volume = np.squeeze(x.get_fdata())
+            volume = np.squeeze(x.get_fdata(dtype=fdata_dtype, caching='unchanged'))
         else:
-            volume = x.get_fdata()
+            volume = x.get_fdata(dtype=fdata_dtype, caching='unchanged')
         aff = x.affine
         header = x.header
     else:  # npz
-        volume = np.load(path_volume)['vol_data']
+        volume = np.load(path_volume if data is None else io.BytesIO(data))['vol_data']
         if squeeze:
             volume = np.squeeze(volume)
         aff = np.eye(4)
@@ -105,13 +115,14 @@ def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=Non
     if dtype is not None:
         if 'int' in dtype:
             volume = np.round(volume)
-        volume = volume.astype(dtype=dtype)
+        volume = volume.astype(dtype=dtype, copy=False)
 
     # align image to reference affine matrix
     if aff_ref is not None:
         from ext.lab2im import edit_volumes  # the import is done here to avoid import loops
         n_dims, _ = get_dims(list(volume.shape), max_channels=10)
-        volume, aff = edit_volumes.align_volume_to_ref(volume, aff, aff_ref=aff_ref, return_aff=True, n_dims=n_dims)
+        volume, aff = edit_volumes.align_volume_to_ref(volume, aff, aff_ref=aff_ref, return_aff=True, n_dims=n_dims,
+                                                       return_copy=False)
 
     if im_only:
         return volume
@@ -914,12 +925,9 @@ def get_mapping_lut(source, dest=None):
 
 def build_training_generator(gen, batchsize):
     """Build generator for training a network."""
+    target = np.zeros((batchsize, 1))  # dummy target, allocated once since it is never modified
     while True:
         inputs = next(gen)
-        if batchsize > 1:
-            target = np.concatenate([np.zeros((1, 1))] * batchsize, 0)
-        else:
-            target = np.zeros((1, 1))
         yield inputs, target
 
 
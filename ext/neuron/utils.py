@@ -40,9 +40,10 @@ def interpn(vol, loc, interp_method='linear'):
         new interpolated volume of the same size as the entries in loc
     """
 
-    if isinstance(loc, (list, tuple)):
-        loc = tf.stack(loc, -1)
-    nb_dims = loc.shape[-1]
+    # keep one location tensor per dimension, so that each coordinate is read contiguously
+    if not isinstance(loc, (list, tuple)):
+        loc = tf.unstack(loc, axis=-1)
+    nb_dims = len(loc)
 
     if len(vol.shape) not in [nb_dims, nb_dims + 1]:
         raise Exception("Number of loc Tensors %d does not match volume dimension %d"
@@ -56,21 +57,23 @@ def interpn(vol, loc, interp_method='linear'):
         vol = K.expand_dims(vol, -1)
 
     # flatten and float location Tensors
-    loc = tf.cast(loc, 'float32')
+    loc = [tf.cast(f, 'float32') for f in loc]
 
     if isinstance(vol.shape, tf.TensorShape):
         volshape = vol.shape.as_list()
     else:
         volshape = vol.shape
 
+    # flatten volume once for all the gathers below
+    flat_vol = tf.reshape(vol, [-1, volshape[-1]])
+
     # interpolate
     if interp_method == 'linear':
-        loc0 = tf.floor(loc)
 
         # clip values
         max_loc = [d - 1 for d in vol.get_shape().as_list()]
-        clipped_loc = [tf.clip_by_value(loc[..., d], 0, max_loc[d]) for d in range(nb_dims)]
-        loc0lst = [tf.clip_by_value(loc0[..., d], 0, max_loc[d]) for d in range(nb_dims)]
+        clipped_loc = [tf.clip_by_value(loc[d], 0, max_loc[d]) for d in range(nb_dims)]
+        loc0lst = [tf.clip_by_value(tf.floor(loc[d]), 0, max_loc[d]) for d in range(nb_dims)]
 
         # get other end of point cube
         loc1 = [tf.clip_by_value(loc0lst[d] + 1, 0, max_loc[d]) for d in range(nb_dims)]
@@ -97,7 +100,7 @@ def interpn(vol, loc, interp_method='linear'):
             subs = [locs[c[d]][d] for d in range(nb_dims)]
 
             idx = sub2ind(vol.shape[:-1], subs)
-            vol_val = tf.gather(tf.reshape(vol, [-1, volshape[-1]]), idx)
+            vol_val = tf.gather(flat_vol, idx)
 
             # get the weight of this cube_pt based on the distance
             # if c[d] is 0 --> want weight = 1 - (pt - floor[pt]) = diff_loc1
@@ -111,15 +114,15 @@ def interpn(vol, loc, interp_method='linear'):
 
     else:
         assert interp_method == 'nearest'
-        roundloc = tf.cast(tf.round(loc), 'int32')
+        roundloc = [tf.cast(tf.round(f), 'int32') for f in loc]
 
         # clip values
         max_loc = [tf.cast(d - 1, 'int32') for d in vol.shape]
-        roundloc = [tf.clip_by_value(roundloc[..., d], 0, max_loc[d]) for d in range(nb_dims)]
+        roundloc = [tf.clip_by_value(roundloc[d], 0, max_loc[d]) for d in range(nb_dims)]
 
         # get values
         idx = sub2ind(vol.shape[:-1], roundloc)
-        interp_vol = tf.gather(tf.reshape(vol, [-1, vol.shape[-1]]), idx)
+        interp_vol = tf.gather(flat_vol, idx)
 
     return interp_vol
 
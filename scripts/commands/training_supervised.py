@@ -74,6 +74,10 @@ parser.add_argument("--wl2_epochs", type=int, dest="wl2_epochs", default=1)
 parser.add_argument("--dice_epochs", type=int, dest="dice_epochs", default=50)
 parser.add_argument("--steps_per_epoch", type=int, dest="steps_per_epoch", default=10000)
 parser.add_argument("--checkpoint", type=str, dest="checkpoint", default=None)
+parser.add_argument("--cache", action='store_true', dest="cache_inputs")
+parser.add_argument("--tfrecords_dir", type=str, dest="tfrecords_dir", default=None)
+parser.add_argument("--mixed_precision", action='store_true', dest="mixed_precision")
+parser.add_argument("--xla", action='store_true', dest="xla")
 
 args = parser.parse_args()
 training(**vars(args))